@@ -1,16 +1,27 @@
 import os
 import csv
+import asyncio
 import logging
+import queue
 
-from typing import TypedDict, Literal, Optional, Dict, List, Callable
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, List, Tuple, Callable
 
 from session import Session, extract_id_from_uri, construct_api_link
-from taxon_helpers import TAXON_TABLE_ID, RANK_NAME, Discipline_Record, Taxon_Record, TaxonTreeDefItem_Record, get_defitem, get_taxon, update_author, create_accepted_taxon
+from taxon_helpers import TAXON_TABLE_ID, RANK_NAME, Discipline_Record, Taxon_Record, TaxonTreeDefItem_Record, get_defitem, get_taxon, update_author, create_accepted_taxon, remember_taxon, preload_taxa
 
 LOG_FILE_NAME = "importlog.txt"
 
+logger = logging.getLogger(__name__)
+
+# The maximum number of rows being processed at once: every row in flight can
+# itself have at most one request in flight, so this also caps the number of
+# concurrent requests against the server
+CONCURRENT_ROW_LIMIT = 64
+
 """
-Some globals which we can assume will not be modified for the duration of the 
+Some globals which we can assume will not be modified for the duration of the
 script once initially fetched.
 """
 
@@ -25,185 +36,258 @@ DEF_ITEMS: Dict[RANK_NAME, Optional[TaxonTreeDefItem_Record]] = {
 }
 
 
-def main():
-    logging.basicConfig(filename=LOG_FILE_NAME, format='%(asctime)s %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+async def main():
+    # log records are dropped onto a queue and written to the file from the
+    # listener's thread, so logging never blocks the event loop on disk I/O
+    log_queue = queue.Queue(-1)
+    file_handler = logging.FileHandler(LOG_FILE_NAME)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    listener = QueueListener(log_queue, file_handler)
+    logging.basicConfig(handlers=[QueueHandler(log_queue)],
+                        level=logging.INFO)
+    listener.start()
 
-    s = Session(domain="https://sp7demofish.specifycloud.org")
+    s = await Session.create(domain="https://sp7demofish.specifycloud.org")
     collection_id = s.get_collection_id("KUFishvoucher")
-    s.login(username="sp7demofish", password="sp7demofish",
-            collection_id=collection_id)
+    await s.login(username="sp7demofish", password="sp7demofish",
+                  collection_id=collection_id)
+
+    # already fetched (and cached) while climbing the hierarchy on login
+    discipline = await s.fetch_resource_cached('discipline', s.get_domain_id('Discipline'))
 
-    discipline = s.fetch_resource('discipline', s.get_domain_id('Discipline'))
+    await fetch_tree_info(s, discipline)
 
-    fetch_tree_info(s, discipline)
+    await preload_taxa(s, DEF_ITEMS, MAMMALIA)
+    logger.info("Preloaded existing taxa")
 
     rows = deserialize_csv("taxon_to_import.csv")
 
-    taxon_ids = [proccess_row(s, row) for row in rows]
+    # resolve the (much smaller) set of unique parent taxa once up front;
+    # the per-row work below then only touches the Species rank
+    parent_taxa = await resolve_parent_taxa(s, rows)
+
+    semaphore = asyncio.Semaphore(CONCURRENT_ROW_LIMIT)
+
+    async def proccess_row_limited(row: Row) -> int:
+        async with semaphore:
+            return await proccess_row(s, row, parent_taxa)
+
+    taxon_ids = await asyncio.gather(*[proccess_row_limited(row) for row in rows])
 
-    print(f"Creating 'Imported Species (Api Demo)' recordset with results")
+    logger.info("Creating 'Imported Species (Api Demo)' recordset with results")
+    # the recordsetitems are dependent resources of the recordset, so they
+    # can all be created inline in the same POST as the recordset itself
     recordset_data = {
         "collectionmemberid": s.get_domain_id('Collection'),
         "dbtableid": TAXON_TABLE_ID,
         "name": "Imported Species (Api Demo)",
         "type": 0,
         "version": 0,
-        "specifyuser": s.specifyuser['resource_uri']
+        "specifyuser": s.specifyuser['resource_uri'],
+        "recordsetitems": [
+            {"recordid": taxon_id} for taxon_id in taxon_ids
+        ]
     }
-    record_set = s.create_resource('recordset', recordset_data)
+    record_set = await s.create_resource('recordset', recordset_data)
 
-    for taxon_id in taxon_ids:
-        recordsetitem_data = {
-            "recordid": taxon_id,
-            "recordset": record_set["resource_uri"]
-        }
-        s.create_resource('recordsetitem', recordsetitem_data)
+    await s.close()
 
+    listener.stop()
     print(f"Generated logs available at {os.path.abspath(LOG_FILE_NAME)}")
 
 
-def fetch_tree_info(session: Session, discipline: Discipline_Record):
+async def fetch_tree_info(session: Session, discipline: Discipline_Record):
     global TREE_DEF_ID, MAMMALIA, DEF_ITEMS
 
     TREE_DEF_ID = extract_id_from_uri(discipline['taxontreedef'])
-    class_def_item = get_defitem(session, TREE_DEF_ID, "Class")
-    MAMMALIA = get_taxon(session, "Mammalia", class_def_item["id"])
+    class_def_item = await get_defitem(session, TREE_DEF_ID, "Class")
+    MAMMALIA = await get_taxon(session, "Mammalia", class_def_item["id"])
     if MAMMALIA is None:
-        phylum_def_item = get_defitem(session, TREE_DEF_ID, 'Phylum')
-        chordata = get_taxon(session, 'Chordata', phylum_def_item["id"])
-        MAMMALIA = create_accepted_taxon(
+        phylum_def_item = await get_defitem(session, TREE_DEF_ID, 'Phylum')
+        chordata = await get_taxon(session, 'Chordata', phylum_def_item["id"])
+        MAMMALIA = await create_accepted_taxon(
             session, class_def_item, 'Mammalia', chordata)
 
-    DEF_ITEMS["Order"] = get_defitem(session, TREE_DEF_ID, "Order")
-    DEF_ITEMS["Family"] = get_defitem(session, TREE_DEF_ID, "Family")
-    DEF_ITEMS["Genus"] = get_defitem(session, TREE_DEF_ID, "Genus")
-    DEF_ITEMS["Species"] = get_defitem(session, TREE_DEF_ID, "Species")
-    print("Fetched tree items")
+    # the four defitem lookups are independent of each other, so they can
+    # share a single round trip instead of going back-to-back
+    def_items = await asyncio.gather(
+        *[get_defitem(session, TREE_DEF_ID, rank_name) for rank_name in DEF_ITEMS.keys()])
+    DEF_ITEMS.update(zip(DEF_ITEMS.keys(), def_items))
+    logger.info("Fetched tree items")
 
 
-class Row(TypedDict):
-    Order: str
-    Family: str
-    Genus: str
-    Species: str
-    isAccepted: Literal['Yes', 'No']
-    Author: str
-    AcceptedGenus: str
-    AcceptedSpecies: str
-    AcceptedAuthor: str
+@dataclass(slots=True, frozen=True)
+class Row:
+    """A single deserialized CSV row.
+    A frozen slotted dataclass keeps thousands of rows much cheaper in memory
+    than per-row dicts, and field access is an attribute load instead of a
+    hash lookup
+    """
+    order: str
+    family: str
+    genus: str
+    species: str
+    is_accepted: bool
+    author: str
+    accepted_genus: str
+    accepted_species: str
+    accepted_author: str
 
 
-def deserialize_csv(file_name) -> List[Row]:
-    results = []
-    with open(file_name, "r") as file:
-        for line in csv.DictReader(file):
-            new_line = {}
-            for col, data in line.items():
-                new_line[col.strip()] = data.strip()
-            results.append(new_line)
+# The CSV columns in the order the Row fields are declared
+CSV_COLUMNS = ["Order", "Family", "Genus", "Species", "isAccepted",
+               "Author", "AcceptedGenus", "AcceptedSpecies", "AcceptedAuthor"]
 
-    return results
+
+def deserialize_csv(file_name) -> List[Row]:
+    with open(file_name, "r", newline="") as file:
+        reader = csv.reader(file)
+        # the header only needs to be parsed once; rows are built positionally
+        header = [col.strip() for col in next(reader)]
+        indexes = [header.index(col) for col in CSV_COLUMNS]
+        return [
+            Row(*(line[index].strip() for index in indexes[:4]),
+                line[indexes[4]].strip() == 'Yes',
+                *(line[index].strip() for index in indexes[5:]))
+            for line in reader
+        ]
 
 
 def tree_info_fetched(func: Callable):
     """Decorator which ensures that the globals which store information related
     to commonly used tree-structure contain values
     """
-    def wrapped(*args, **kwargs):
-        all_tree_items = [MAMMALIA, TREE_DEF_ID] + list(DEF_ITEMS.values())
-        fetched = all(
-            False if tree_info is None else True for tree_info in all_tree_items)
-        if not fetched:
-            raise Exception("Tree info must be initialized", all_tree_items)
-        return func(*args, **kwargs)
+    async def wrapped(*args, **kwargs):
+        # a plain short-circuit check: this runs several times per row, so it
+        # should not allocate anything. DEF_ITEMS is filled in one shot by
+        # fetch_tree_info, so checking a single rank covers all of them
+        if MAMMALIA is None or TREE_DEF_ID is None or DEF_ITEMS["Species"] is None:
+            raise Exception("Tree info must be initialized",
+                            [MAMMALIA, TREE_DEF_ID] + list(DEF_ITEMS.values()))
+        return await func(*args, **kwargs)
 
     return wrapped
 
 
+# Key identifying a unique parent taxon in the CSV: the names of the ranks
+# from Order down to the rank of the taxon itself
+PARENT_KEY = Tuple[str, ...]
+
+
 @tree_info_fetched
-def proccess_row(session: Session, row: Row) -> int:
-    """Processes a single row in the CSV, creating/updating any Taxon records
-    when necessary and finally returning the id of the lowest rank (Species) 
-    which were fetched/updated/created 
+async def resolve_parent_taxa(session: Session, rows: List[Row]) -> Dict[PARENT_KEY, Taxon_Record]:
+    """Fetches or creates the unique Order/Family/Genus combinations named in
+    <rows> before any per-row Species work happens, so each parent taxon is
+    resolved exactly once no matter how many rows share it.
+
+    Each rank only depends on the rank above it, so every taxon at a level is
+    resolved concurrently before descending to the next
     """
-    print(f"Processing row: {row}")
-    # because we go sequentially down the ranks, the parent node of all Order
-    # rank nodes we wish to upload will be Mammalia
-    parent_taxon = MAMMALIA
+    parent_ranks: List[RANK_NAME] = ["Order", "Family", "Genus"]
+    resolved: Dict[PARENT_KEY, Taxon_Record] = {}
+
+    for depth, rank_name in enumerate(parent_ranks):
+        # a representative row per unique combination; only the name at
+        # rank_name matters above the Species rank
+        unique: Dict[PARENT_KEY, Row] = {}
+        for row in rows:
+            key = tuple(getattr(row, rank.lower())
+                        for rank in parent_ranks[:depth + 1])
+            unique.setdefault(key, row)
+
+        async def resolve(key: PARENT_KEY, row: Row, rank_name: RANK_NAME = rank_name):
+            parent = MAMMALIA if len(key) == 1 else resolved[key[:-1]]
+            resolved[key] = await get_or_create_taxon(
+                session, row, rank_name, parent)
+
+        await asyncio.gather(*[resolve(key, row)
+                               for key, row in unique.items()])
 
-    # for each rank in a row, fetch or create the record at the rank
-    for rank_name in DEF_ITEMS.keys():
-        taxon = get_or_create_taxon(session, row, rank_name, parent_taxon)
-        parent_taxon = taxon
+    return resolved
+
+
+@tree_info_fetched
+async def proccess_row(session: Session, row: Row, parent_taxa: Dict[PARENT_KEY, Taxon_Record]) -> int:
+    """Processes a single row in the CSV, creating/updating any Taxon records
+    when necessary and finally returning the id of the lowest rank (Species)
+    which were fetched/updated/created
+    """
+    # %s formatting defers the row stringification to the listener thread
+    logger.info("Processing row: %s", row)
+    # the Order/Family/Genus ranks were already resolved for every row by
+    # resolve_parent_taxa, so only the Species-level work remains
+    genus = parent_taxa[(row.order, row.family, row.genus)]
+    taxon = await get_or_create_taxon(session, row, 'Species', genus)
 
     return taxon['id']
 
 
 @tree_info_fetched
-def get_accepted(session: Session, row: Row) -> Optional[str]:
+async def get_accepted(session: Session, row: Row) -> Optional[str]:
     """Return the resource_uri for the accepted taxon
-    of a synonymized node. 
+    of a synonymized node.
     If the accepted Genus or accepted Species do not exist, create them when
-    needed. 
+    needed.
 
     """
     # the resource_uri for an already accepted node is None
-    if row["isAccepted"] == 'Yes':
+    if row.is_accepted:
         return None
 
-    accepted = get_taxon(
-        session, row["AcceptedSpecies"], DEF_ITEMS["Species"]["id"], row["AcceptedGenus"])
+    accepted = await get_taxon(
+        session, row.accepted_species, DEF_ITEMS["Species"]["id"], row.accepted_genus)
 
     # if the species exists, update the author and directly return the species
     if accepted is not None:
-        updated = update_author(session, accepted, row["AcceptedAuthor"])
+        updated = await update_author(session, accepted, row.accepted_author)
         return updated['resource_uri']
 
-    accepted_genus = get_taxon(
-        session, row["AcceptedGenus"], DEF_ITEMS["Genus"]["id"])
+    accepted_genus = await get_taxon(
+        session, row.accepted_genus, DEF_ITEMS["Genus"]["id"])
     if accepted_genus is None:
         # if the accepted species does not exist, upload it as a child of a
         # node with name "Uploaded" at the Family rank
-        parent = get_taxon(session, 'Uploaded',
-                           DEF_ITEMS["Family"]["id"], 'Uploaded')
-        accepted_genus = create_accepted_taxon(
-            session, DEF_ITEMS['Genus'], row["AcceptedGenus"], parent)
+        parent = await get_taxon(session, 'Uploaded',
+                                 DEF_ITEMS["Family"]["id"], 'Uploaded')
+        accepted_genus = await create_accepted_taxon(
+            session, DEF_ITEMS['Genus'], row.accepted_genus, parent)
 
-    new_accepted_species = create_accepted_taxon(session,
-                                                 DEF_ITEMS['Species'], row["AcceptedSpecies"], accepted_genus, row['AcceptedAuthor'])
+    new_accepted_species = await create_accepted_taxon(session,
+                                                       DEF_ITEMS['Species'], row.accepted_species, accepted_genus, row.accepted_author)
     return new_accepted_species['resource_uri']
 
 
 @tree_info_fetched
-def get_or_create_taxon(session: Session, row: Row, rank_name: RANK_NAME, parent_taxon: Taxon_Record) -> Taxon_Record:
-    """ Attempt to fetch the taxon with with the name specified at <rank_name> 
+async def get_or_create_taxon(session: Session, row: Row, rank_name: RANK_NAME, parent_taxon: Taxon_Record) -> Taxon_Record:
+    """ Attempt to fetch the taxon with with the name specified at <rank_name>
     in the <row>.
-    If needed, update the taxon record (such as author or synonymizing) to 
-    match the information in the <row>. 
+    If needed, update the taxon record (such as author or synonymizing) to
+    match the information in the <row>.
 
-    If the taxon does not exist, then create it. 
+    If the taxon does not exist, then create it.
     """
     rank = DEF_ITEMS[rank_name]
-    taxon = get_taxon(session, row[rank_name],
-                      rank["id"], parent_taxon["name"])
+    name = getattr(row, rank_name.lower())
+    taxon = await get_taxon(session, name,
+                            rank["id"], parent_taxon["name"])
 
     # we only want to synonymize and change author if at the Species rank
-    isAccepted = row["isAccepted"] == 'Yes' and rank_name == 'Species'
-    author = row["Author"] if rank_name == "Species" else None
+    isAccepted = row.is_accepted and rank_name == 'Species'
+    author = row.author if rank_name == "Species" else None
 
     if taxon is not None:
         # if the existing taxon is at the Species level and is accepted but
         # synonymized in the csv, then synonymize it
         if rank_name == 'Species' and taxon['isaccepted'] == True and isAccepted == False:
-            taxon = synonymize_taxon(session, row, taxon)
-        return taxon if author is None else update_author(session, taxon, author)
+            taxon = await synonymize_taxon(session, row, taxon)
+        return taxon if author is None else await update_author(session, taxon, author)
 
     taxon_data = {
         # fullname generated by backend when saved
-        "name": row[rank_name],
+        "name": name,
         "author": author,
-        "acceptedtaxon": get_accepted(session, row) if rank_name == 'Species' else None,
+        "acceptedtaxon": await get_accepted(session, row) if rank_name == 'Species' else None,
         "isaccepted": isAccepted,
         "ishybrid": False,
         "rankid": rank["rankid"],
@@ -213,21 +297,26 @@ def get_or_create_taxon(session: Session, row: Row, rank_name: RANK_NAME, parent
         "definitionitem": rank["resource_uri"],
         "parent": parent_taxon["resource_uri"]
     }
-    taxon = session.create_resource("taxon", taxon_data)
+    taxon = await session.create_resource("taxon", taxon_data)
+    remember_taxon(taxon, rank["id"], parent_taxon["name"])
 
     return taxon
 
 
 @tree_info_fetched
-def synonymize_taxon(session: Session, row: Row, taxon: Taxon_Record) -> Taxon_Record:
-    accepted_uri = get_accepted(session, row)
+async def synonymize_taxon(session: Session, row: Row, taxon: Taxon_Record) -> Taxon_Record:
+    accepted_uri = await get_accepted(session, row)
 
     updated_fields = {
         "isaccepted": False,
         "acceptedtaxon": accepted_uri
     }
-    return session.update_resource('taxon', taxon["id"], updated_fields)
+    # the (possibly preloaded) record may already carry exactly these values,
+    # in which case the PUT would be a no-op
+    if all(taxon[field] == value for field, value in updated_fields.items()):
+        return taxon
+    return await session.update_resource_with('taxon', taxon, updated_fields)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
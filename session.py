@@ -1,8 +1,9 @@
-import json
-import requests
-import re
+import asyncio
 import logging
 
+import httpx
+import orjson
+
 from functools import wraps
 from typing import Literal, Optional, Dict, Tuple, Union, Any, List
 
@@ -33,24 +34,33 @@ FIELD_VALUE = Union[int, str, bool, None,
                     List['SERIALIZED_RECORD'], 'SERIALIZED_RECORD']
 SERIALIZED_RECORD = Dict[str, FIELD_VALUE]
 
-# Regex matching api uris for extracting the model name and id number.
-URI_RE = re.compile(r'^\/api\/specify\/(\w+)\/($|(\d+))')
+# The maximum number of requests the Session will keep in flight against the
+# server at once
+CONCURRENT_REQUEST_LIMIT = 64
+
+# Statuses which indicate a transient server-side problem worth retrying
+# with backoff rather than failing the whole import
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.2
 
 
 def parse_uri(uri: str) -> Tuple[str, str]:
     """Return the model name and id from a resource URI."""
-    match = URI_RE.match(uri)
-    assert match is not None, f"Bad URI: {uri}"
-    groups = match.groups()
-    table, resource_id = groups[0], groups[2]
+    # resource uris have the rigid shape /api/specify/<table>/<id>/, so
+    # plain string splitting is much cheaper than a regex on this hot path
+    parts = uri.strip('/').split('/')
+    assert len(parts) >= 3 and parts[0] == 'api' and parts[1] == 'specify', \
+        f"Bad URI: {uri}"
+    table = parts[2]
+    resource_id = parts[3] if len(parts) > 3 else None
     return table, resource_id
 
 
 def extract_id_from_uri(uri: str):
-    """From a given uri to a resource, extract the id 
+    """From a given uri to a resource, extract the id
     """
-    _, resource_id = parse_uri(uri)
-    return int(resource_id)
+    return int(uri.rstrip('/').rsplit('/', 1)[-1])
 
 
 def construct_api_link(table: str, id: int):
@@ -61,13 +71,13 @@ def construct_api_link(table: str, id: int):
 
 def ensure_login(func):
     """Decorator which ensures a function which accepts a Session as the first
-    parameter is logged in before the function is called 
+    parameter is logged in before the function is called
     """
     @wraps(func)
-    def wrapped(session: "Session", *args: Tuple, **kwargs: Dict[str, Any]):
-        if session.specifyuser is None:
+    async def wrapped(session: "Session", *args: Tuple, **kwargs: Dict[str, Any]):
+        if not session._logged_in:
             raise Exception("Must be logged in")
-        return func(session, *args, **kwargs)
+        return await func(session, *args, **kwargs)
 
     return wrapped
 
@@ -76,7 +86,7 @@ class Session:
     def __init__(self, *,  domain="http://localhost", port=None) -> None:
         self.domain = domain
         self.port = port
-        self.session = requests.Session()
+        self.session: Optional[httpx.AsyncClient] = None
         self._collections: Dict[str, int] = dict()
         self._hierarchy: Dict[HIEARCHY, int] = {
             "Collection": -1,
@@ -85,55 +95,124 @@ class Session:
             "Institution": -1
         }
         self.specifyuser: Optional[SERIALIZED_RECORD] = None
-        self._init_session()
+        self._logged_in = False
+        # resources fetched while climbing the hierarchy never change for
+        # the lifetime of the session, so they are kept for reuse
+        self._resource_cache: Dict[Tuple[str, int], SERIALIZED_RECORD] = dict()
+
+    @classmethod
+    async def create(cls, *, domain="http://localhost", port=None) -> "Session":
+        """Constructs a Session and performs the initial handshake with the
+        server.
+
+        The httpx.AsyncClient must be used from within a running event
+        loop, so use this instead of constructing a Session directly:
+        ```
+        session = await Session.create(domain="http://localhost")
+        ```
 
-    def send_request(self, method: REQUEST_METHOD, endpoint: str, *args, **kwargs) -> requests.Response:
-        """Sends a request with method <method> to the <endpoint>. 
-        Specifically, gets the corresponding method from `requests` and 
-        supplies it with <args> and <kwargs>. 
+        HTTP/2 is enabled so that concurrent requests are multiplexed over
+        a single connection instead of each holding a TCP connection
+        """
+        session = cls(domain=domain, port=port)
+        session.session = httpx.AsyncClient(
+            base_url=session.domain,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                # connection-level failures are retried by the transport;
+                # transient statuses are handled in send_request
+                retries=MAX_RETRIES,
+                limits=httpx.Limits(max_connections=CONCURRENT_REQUEST_LIMIT,
+                                    max_keepalive_connections=32)))
+        await session._init_session()
+        return session
+
+    async def send_request(self, method: REQUEST_METHOD, endpoint: str, *args, **kwargs) -> httpx.Response:
+        """Sends a request with method <method> to the <endpoint>.
+        Specifically, sends the request through the httpx.AsyncClient with
+        <args> and <kwargs>.
 
         The following are equivalent (assuming the domain is `http://localhost`):
         ```
-        r = session.send_request('POST', '/api/specify/agent/', json={"lastname": "Doe"}) 
-        r = requests.post('http://localhost/api/specify/agent/', json={"lastname": "Doe"})
+        r = await session.send_request('POST', '/api/specify/agent/', json={"lastname": "Doe"})
+        r = await client.post('http://localhost/api/specify/agent/', json={"lastname": "Doe"})
         ```
         """
-        full_url = self.domain + endpoint
-        request_function = getattr(self.session, method.lower(), None)
-        if request_function is None or not callable(request_function):
+        if method.upper() not in ('GET', 'PUT', 'POST', 'DELETE'):
             raise InvalidMethod(method)
 
-        logger.info(f"{method} | {full_url} {
-                    '| ' + str(kwargs) if len(kwargs) > 0 else ''}")
-
-        return request_function(full_url, *args, **kwargs)
-
-    def login(self, username: str, password: str, collection_id: int):
-        """Login as Specifyuser <username> with password <password> to 
-        collection <collection_id> 
+        logger.info(f"{method} | {self.domain + endpoint} " +
+                    (f"| {kwargs}" if len(kwargs) > 0 else ""))
+
+        # request bodies are serialized with orjson as well; the json=
+        # keyword would fall back to httpx's stdlib encoder
+        if 'json' in kwargs:
+            kwargs['content'] = orjson.dumps(kwargs.pop('json'))
+            kwargs.setdefault('headers', {})[
+                'Content-Type'] = 'application/json'
+
+        for attempt in range(MAX_RETRIES + 1):
+            r = await self.session.request(method, endpoint, *args, **kwargs)
+
+            # POSTs are not idempotent, so a transient status is handed back
+            # to the caller rather than risking a duplicate create
+            if (r.status_code not in RETRY_STATUSES
+                    or method.upper() == 'POST' or attempt == MAX_RETRIES):
+                return r
+
+            # prefer the server's own throttling hint over the backoff curve
+            retry_after = r.headers.get('Retry-After', '')
+            delay = float(retry_after) if retry_after.isdigit() \
+                else BACKOFF_FACTOR * (2 ** attempt)
+            logger.info(
+                f"{r.status_code} | retrying {endpoint} in {delay}s")
+            await asyncio.sleep(delay)
+
+    async def login(self, username: str, password: str, collection_id: int):
+        """Login as Specifyuser <username> with password <password> to
+        collection <collection_id>
         """
-        r = self.send_request('PUT', '/context/login/', json={
-                              "username": username, "password": password, "collection": collection_id})
+        r = await self.send_request('PUT', '/context/login/', json={
+            "username": username, "password": password, "collection": collection_id})
 
         if r.status_code == 403:
             raise InvalidCredentials(r.content)
         if r.status_code == 400:
             raise Exception(r.content)
-        self.specifyuser = json.loads(self.send_request(
-            'GET', '/context/user.json').content)
-        self.session.headers.update({"X-CSRFToken": r.cookies["csrftoken"]})
-        self._update_hierarchy(collection_id)
+        self.session.headers.update(
+            {"X-CSRFToken": r.cookies["csrftoken"]})
+        self._logged_in = True
+        # the user fetch is independent of the hierarchy climb, so overlap
+        # the two instead of spending an extra round trip up front
+        user_response, _ = await asyncio.gather(
+            self.send_request('GET', '/context/user.json'),
+            self._update_hierarchy(collection_id))
+        self.specifyuser = self._parse_response(user_response)
 
     def get_domain_id(self, scope: HIEARCHY) -> Optional[int]:
         return self._hierarchy.get(scope, None)
 
+    @staticmethod
+    def _parse_response(r: httpx.Response, expected_status: int = 200):
+        """The single place where API responses are decoded: checks the
+        status of the response <r> and parses the body with orjson exactly
+        once. Callers with endpoint-specific statuses (e.g. the 409 version
+        conflict on updates) handle those before delegating here
+        """
+        if r.status_code == 403:
+            raise NoPermission(r.content)
+        elif r.status_code != expected_status:
+            raise Exception(r.status_code, r.content)
+
+        return orjson.loads(r.content)
+
     @ensure_login
-    def fetch_resource(self, table: str, resource_id: int) -> SERIALIZED_RECORD:
+    async def fetch_resource(self, table: str, resource_id: int) -> SERIALIZED_RECORD:
         """Returns the serialzied record from <table> with id of resource_id
 
         Literal field values are directly mapped from `{field : value}` in the
-        returned response. 
-        As in, 
+        returned response.
+        As in,
         ```py
         {
         "text1": "someStringValue",
@@ -154,11 +233,11 @@ class Session:
         }
         ```
         ---
-        Dependent resources are returned by either None, serialized inline 
-        (in the case of a -to-one relationship), or each serialized in an array 
+        Dependent resources are returned by either None, serialized inline
+        (in the case of a -to-one relationship), or each serialized in an array
         (in the case of a -to-many relationship)
 
-        For example: 
+        For example:
         ```py
         {
             "collectionobjectattribute" : {
@@ -178,56 +257,83 @@ class Session:
         }
         ```
         """
-        r = self.send_request(
+        r = await self.send_request(
             'GET', f'/api/specify/{table.lower()}/{resource_id}/')
 
-        if r.status_code == 403:
-            raise NoPermission(r.content)
-        elif r.status_code != 200:
-            raise Exception(r.status_code, r.content)
+        return self._parse_response(r)
 
-        return json.loads(r.content)
+    @ensure_login
+    async def fetch_resource_cached(self, table: str, resource_id: int) -> SERIALIZED_RECORD:
+        """Like fetch_resource, but memoizes the serialized record on the
+        Session.
+        Only suitable for resources which can be assumed not to change for
+        the lifetime of the session (e.g. the discipline/division/institution
+        records climbed through on login)
+        """
+        key = (table.lower(), resource_id)
+        if key not in self._resource_cache:
+            self._resource_cache[key] = await self.fetch_resource(
+                table, resource_id)
+        return self._resource_cache[key]
 
     @ensure_login
-    def fetch_collection(self, url: str) -> Tuple[SERIALIZED_RECORD]:
-        """Returns the array of serialized objects returned from fetching 
-        the url
+    async def fetch_collection(self, url: str, params: Optional[Dict[str, Any]] = None) -> List[SERIALIZED_RECORD]:
+        """Returns the array of serialized objects returned from fetching
+        the url.
+
+        Query parameters should be passed via <params> rather than spliced
+        into the url so that values with reserved or non-ascii characters
+        are properly encoded
         """
-        r = self.send_request('GET', url)
+        r = await self.send_request('GET', url, params=params)
 
-        if r.status_code == 403:
-            raise NoPermission(r.content)
-        elif r.status_code != 200:
-            raise Exception(r.status_code, r.content)
+        return self._parse_response(r)['objects']
 
-        return tuple(json.loads(r.content)['objects'])
+    @ensure_login
+    async def fetch_all(self, url: str, params: Optional[Dict[str, Any]] = None, page_size: int = 1000) -> List[SERIALIZED_RECORD]:
+        """Returns every serialized object in the collection at <url>
+        filtered by the query parameters in <params>, following limit/offset
+        pagination until the total_count reported by the server is exhausted
+        """
+        params = dict(params or {})
+        objects: List[SERIALIZED_RECORD] = []
+        offset = 0
+        while True:
+            params.update(limit=page_size, offset=offset)
+            r = await self.send_request('GET', url, params=params)
+
+            content = self._parse_response(r)
+            objects.extend(content['objects'])
+            offset += page_size
+            if offset >= content['meta']['total_count']:
+                return objects
 
     @ensure_login
-    def create_resource(self, table: str, data: SERIALIZED_RECORD) -> SERIALIZED_RECORD:
+    async def create_resource(self, table: str, data: SERIALIZED_RECORD) -> SERIALIZED_RECORD:
         """Creates a <table> resource with the data provided in <data>.
 
         Independent relationships can be established via the resource_uri of
         the other resource. As in:
         ```py
-        # The following CollectionObject will be in the Collection with an id 
+        # The following CollectionObject will be in the Collection with an id
         # of 4
-        session.create_resource("collectionobject", {
+        await session.create_resource("collectionobject", {
             ... # Other CO data
             "collection": "/api/specify/collection/4/"
         })
         ```
         ---
-        Dependent resources of <table> can be created at the same time as 
+        Dependent resources of <table> can be created at the same time as
         the record of <table>, as in the following examples:
 
         ```py
-        session.create_resource('collectionobject', {
+        await session.create_resource('collectionobject', {
             ... # CO data
             "collectionobjectattribute": {
                 ... # serialzied collectionobjectattribute
             }
         })
-        session.create_resource('collectionobject', {
+        await session.create_resource('collectionobject', {
             ... # CO data
             "preparations": [
                 {
@@ -240,33 +346,28 @@ class Session:
         })
         ```
         """
-        r = self.send_request(
+        r = await self.send_request(
             'POST', f'/api/specify/{table.lower()}/', json=data)
 
-        if r.status_code == 403:
-            raise NoPermission(r.content)
-        elif r.status_code != 201:
-            raise Exception(r.status_code, r.content)
-
-        return json.loads(r.content)
+        return self._parse_response(r, expected_status=201)
 
     @ensure_login
-    def update_resource(self, table: str, resource_id: int, updated: SERIALIZED_RECORD) -> SERIALIZED_RECORD:
-        """Updates the <table> resource identified with <resource_id> with the 
-        keys/values in `updated` where the keys are field names 
+    async def update_resource(self, table: str, resource_id: int, updated: SERIALIZED_RECORD) -> SERIALIZED_RECORD:
+        """Updates the <table> resource identified with <resource_id> with the
+        keys/values in `updated` where the keys are field names
         mapping to values.
-        All other fields/relationships not specified in 
-        `updated` do not get changed. 
+        All other fields/relationships not specified in
+        `updated` do not get changed.
         ---
-        Dependent records of <table> can be directly modified and created 
-        For example: 
+        Dependent records of <table> can be directly modified and created
+        For example:
         ```py
-        session.update_resource('collectionobject', 1, {
+        await session.update_resource('collectionobject', 1, {
             "collectionobjectattribute": {
                 ... # serialzied collectionobjectattribute
             }
         })
-        session.update_resource('collectionobject', 1, {
+        await session.update_resource('collectionobject', 1, {
             "preparations": [
                 {
                     ... #prep1
@@ -278,28 +379,54 @@ class Session:
         })
         ```
         """
-        current_resource = self.fetch_resource(table, resource_id)
+        current_resource = await self.fetch_resource(table, resource_id)
         current_resource.update(updated)
-        resp = self.send_request(
+        resp = await self.send_request(
             'PUT', construct_api_link(table, resource_id), json=current_resource)
         if resp.status_code == 400:
             raise Exception(
                 "Resource version needs to be included", resp.content)
         elif resp.status_code == 409:
             raise VersionMismatch(resp.content)
-        elif resp.status_code != 200:
-            raise Exception(resp.status_code, resp.content)
 
-        return json.loads(resp.content)
+        return self._parse_response(resp)
 
     @ensure_login
-    def logout(self):
-        self.send_request('PUT', '/context/login/',
-                          json={"username": None, "password": None, "collection": self.get_domain_id('Collection')})
+    async def update_resource_with(self, table: str, record: SERIALIZED_RECORD, updated: SERIALIZED_RECORD) -> SERIALIZED_RECORD:
+        """Updates the <table> resource using the already-serialized <record>
+        the caller holds: the keys/values in <updated> are merged into
+        <record> locally and PUT in a single round trip, skipping the
+        refetch that update_resource performs.
+
+        If the server reports a version mismatch (meaning the resource
+        changed since <record> was serialized), fall back to
+        update_resource, which refetches and retries the update once.
+        """
+        merged = {**record, **updated}
+        resp = await self.send_request(
+            'PUT', construct_api_link(table, record["id"]), json=merged)
+        if resp.status_code == 409:
+            return await self.update_resource(table, record["id"], updated)
+        elif resp.status_code == 400:
+            raise Exception(
+                "Resource version needs to be included", resp.content)
+
+        return self._parse_response(resp)
+
+    @ensure_login
+    async def logout(self):
+        await self.send_request('PUT', '/context/login/',
+                                json={"username": None, "password": None, "collection": self.get_domain_id('Collection')})
         self.specifyuser = None
+        self._logged_in = False
+
+    async def close(self):
+        """Closes the underlying httpx.AsyncClient and its connections
+        """
+        await self.session.aclose()
 
     def get_collection_id(self, collection_name: str) -> Optional[int]:
-        """Returns the collection id of the given `collection_name`. 
+        """Returns the collection id of the given `collection_name`.
         Returns None if no Collection exists with the name
         """
         return self._collections.get(collection_name, None)
@@ -310,20 +437,23 @@ class Session:
         """
         return self._collections
 
-    def _init_session(self) -> None:
-        r = self.send_request('GET', "/context/login/")
-        content = json.loads(r.content)
-        self.session.headers.update({"X-CSRFToken": r.cookies["csrftoken"]})
+    async def _init_session(self) -> None:
+        r = await self.send_request('GET', "/context/login/")
+        content = self._parse_response(r)
+        self.session.headers.update(
+            {"X-CSRFToken": r.cookies["csrftoken"]})
         self._collections = {collection: collection_id for (
             collection, collection_id) in content['collections'].items()}
 
-    def _update_hierarchy(self, collection_id):
-        dis_id = extract_id_from_uri(self.fetch_resource(
-            'collection', collection_id)['discipline'])
+    async def _update_hierarchy(self, collection_id):
+        # these fetches are sequentially dependent: each level of the
+        # hierarchy is only known from the resource above it
+        dis_id = extract_id_from_uri((await self.fetch_resource_cached(
+            'collection', collection_id))['discipline'])
         div_id = extract_id_from_uri(
-            self.fetch_resource('discipline', dis_id)['division'])
+            (await self.fetch_resource_cached('discipline', dis_id))['division'])
         inst_id = extract_id_from_uri(
-            self.fetch_resource('division', div_id)['institution'])
+            (await self.fetch_resource_cached('division', div_id))['institution'])
 
         self._hierarchy['Institution'] = inst_id
         self._hierarchy['Division'] = div_id
@@ -1,6 +1,6 @@
-from typing import Optional, Literal, Type
+from typing import Dict, Optional, Literal, Tuple, Type
 
-from session import Session, SERIALIZED_RECORD
+from session import Session, SERIALIZED_RECORD, extract_id_from_uri
 
 # from the Specify 6 /config/specify_tableid_listing.xml file
 # needed to create a record set
@@ -19,39 +19,95 @@ Discipline_Record = Type[SERIALIZED_RECORD]
 Taxon_Record = Type[SERIALIZED_RECORD]
 TaxonTreeDefItem_Record = Type[SERIALIZED_RECORD]
 
+# Caches for taxa and defitems which have already been fetched over HTTP.
+# The same (name, rank, parent) combinations repeat across many rows of the
+# CSV, so memoizing the lookups removes most of the GET traffic.
+# The Session is excluded from the keys: a single session is used for the
+# lifetime of the script
+_TAXON_CACHE: Dict[Tuple[str, int, Optional[str]],
+                   Optional[Taxon_Record]] = {}
+_DEFITEM_CACHE: Dict[Tuple[int, str], TaxonTreeDefItem_Record] = {}
 
-def get_defitem(session: Session, tree_def_id: int, rank_name: RANK_NAME) -> TaxonTreeDefItem_Record:
-    """Returns the serialized taxontreedefitem defined with <rank_name> on a 
+
+def remember_taxon(taxon: Taxon_Record, tree_def_item_id: int, parent_name: Optional[str] = None) -> None:
+    """Seeds the taxon cache with a newly created <taxon> so later lookups for
+    the same name and rank skip the HTTP GET (and do not see a stale cached
+    miss from before the taxon was created)
+    """
+    _TAXON_CACHE[(taxon["name"], tree_def_item_id, parent_name)] = taxon
+    # a lookup at this rank which does not restrict by parent name should
+    # also find the new taxon
+    if parent_name is not None:
+        _TAXON_CACHE[(taxon["name"], tree_def_item_id, None)] = taxon
+
+
+async def preload_taxa(session: Session, def_items: Dict[RANK_NAME, TaxonTreeDefItem_Record], root: Taxon_Record) -> None:
+    """Fetches every taxon at each rank in <def_items> in a few paginated
+    sweeps and seeds the taxon cache with them, collapsing the per-name GETs
+    into O(pages) bulk requests.
+
+    The ranks in <def_items> are walked top-down (starting under <root>) so
+    each taxon's parent name is already known when the taxon is cached.
+    Lookups for taxa not present after the preload still fall back to HTTP
+    in get_taxon
+    """
+    id_to_name = {root["id"]: root["name"]}
+    for def_item in def_items.values():
+        taxa = await session.fetch_all(
+            '/api/specify/taxon/', params={'definitionitem': def_item["id"]})
+        for taxon in taxa:
+            id_to_name[taxon["id"]] = taxon["name"]
+            parent_name = None if taxon["parent"] is None else id_to_name.get(
+                extract_id_from_uri(taxon["parent"]))
+            remember_taxon(taxon, def_item["id"], parent_name)
+
+
+async def get_defitem(session: Session, tree_def_id: int, rank_name: RANK_NAME) -> TaxonTreeDefItem_Record:
+    """Returns the serialized taxontreedefitem defined with <rank_name> on a
     given TaxonTreeDef with id <tree_def_id>
     """
-    ranks = session.fetch_collection(
-        f'/api/specify/taxontreedefitem/?name={rank_name}&treedef={tree_def_id}')
+    key = (tree_def_id, rank_name)
+    if key in _DEFITEM_CACHE:
+        return _DEFITEM_CACHE[key]
+
+    ranks = await session.fetch_collection(
+        '/api/specify/taxontreedefitem/',
+        params={'name': rank_name, 'treedef': tree_def_id})
     if len(ranks) == 0:
         raise Exception(f"No taxontreedefitems with name {rank_name}")
+
+    _DEFITEM_CACHE[key] = ranks[0]
     return ranks[0]
 
 
-def get_taxon(session: Session, name: str, tree_def_item_id: int, parent_name: Optional[str] = None) -> Optional[Taxon_Record]:
-    """Returns the serialized Taxon record which has name <name> with the 
+async def get_taxon(session: Session, name: str, tree_def_item_id: int, parent_name: Optional[str] = None) -> Optional[Taxon_Record]:
+    """Returns the serialized Taxon record which has name <name> with the
     taxontreedefitem <tree_def_item_id>
 
-    If <parent_name> is provided, further restrict the search to only include 
+    If <parent_name> is provided, further restrict the search to only include
     Taxon records of the rank and name with parent's of name <parent_name>
 
     If no Taxon record was found matching the critera, return None
     """
-    parent_query = '' if parent_name is None else f'&parent__name={
-        parent_name}'
+    key = (name, tree_def_item_id, parent_name)
+    if key in _TAXON_CACHE:
+        return _TAXON_CACHE[key]
 
-    taxons = session.fetch_collection(
-        f'/api/specify/taxon/?name={name}&definitionitem={tree_def_item_id}{parent_query}')
-    if len(taxons) == 0:
-        return None
+    # only the first match is ever used, so ask the server for at most one;
+    # params= delegates the URL-encoding of taxon names to the client
+    params = {'name': name, 'definitionitem': tree_def_item_id, 'limit': 1}
+    if parent_name is not None:
+        params['parent__name'] = parent_name
+    taxons = await session.fetch_collection('/api/specify/taxon/', params=params)
 
-    return taxons[0]
+    # misses are cached too: remember_taxon overwrites the entry if the
+    # taxon is later created
+    taxon = None if len(taxons) == 0 else taxons[0]
+    _TAXON_CACHE[key] = taxon
+    return taxon
 
 
-def create_accepted_taxon(session: Session, def_item: TaxonTreeDefItem_Record, name: str, parent: Taxon_Record, author: Optional[str] = None) -> Taxon_Record:
+async def create_accepted_taxon(session: Session, def_item: TaxonTreeDefItem_Record, name: str, parent: Taxon_Record, author: Optional[str] = None) -> Taxon_Record:
     """Creates a new Taxon record with taxontreedefitem <def_item>, name <name>, parent <parent>, and author <author>
     """
     taxon_data = {
@@ -67,14 +123,15 @@ def create_accepted_taxon(session: Session, def_item: TaxonTreeDefItem_Record, n
         "definitionitem": def_item["resource_uri"],
         "parent": parent["resource_uri"]
     }
-    new_taxon = session.create_resource('taxon', taxon_data)
+    new_taxon = await session.create_resource('taxon', taxon_data)
+    remember_taxon(new_taxon, def_item["id"], parent["name"])
     return new_taxon
 
 
-def update_author(session: Session, taxon: Taxon_Record, author: str) -> Taxon_Record:
-    """Given a serialized Taxon record <taxon>, and a string representing an 
+async def update_author(session: Session, taxon: Taxon_Record, author: str) -> Taxon_Record:
+    """Given a serialized Taxon record <taxon>, and a string representing an
     author, update the <taxon> record to have author <author>
     """
     if taxon['author'] == author:
         return taxon
-    return session.update_resource('taxon', taxon['id'], {"author": author})
+    return await session.update_resource_with('taxon', taxon, {"author": author})